@@ -1,11 +1,22 @@
 import streamlit as st
 import google.generativeai as genai
+from google import genai as google_genai
 import tempfile
 import os
+import string
+import hashlib
+import re
 import time
+import itertools
+import json
+import zipfile
 from pathlib import Path
+from contextlib import suppress
 from docx import Document
-from io import BytesIO
+from io import BytesIO, StringIO
+from typing import BinaryIO, Union
+from concurrent.futures import ThreadPoolExecutor
+from lxml import etree
 
 # --- 頁面設定 ---
 st.set_page_config(
@@ -25,23 +36,295 @@ st.markdown("""
     </style>
 """, unsafe_allow_html=True)
 
+# =========================
+# Prompt 模板（模組層級預先編譯，方便重複使用與測試）
+# =========================
+
+PROMPT_S1 = string.Template("""
+# Role
+你是一位資深 CRO 顧問與 Landing Page 策略設計師。
+
+# 任務目標
+請針對我提供的【競品 Landing Page 資料】進行「結構化的逆向工程」，輸出一份《競品 Landing Page 戰略拆解報告》。
+
+競品資料來源包含：
+1. 我上傳的檔案與截圖（請一併納入分析）
+2. 我補充貼上的文字說明或網址：
+${competitor_text}
+
+# 分析觀點
+請聚焦在「如何說服訪客完成轉換」，從以下角度拆解：
+
+1. **定位與主張 (Positioning & Core Promise)**
+2. **頁面結構與資訊架構 (Information Architecture)**
+3. **首屏設計 (Above-the-fold Strategy)**
+4. **文案語氣與說服手法 (Copy & Persuasion Technique)**
+5. **視覺與互動策略 (Visual & Interaction)**
+6. **轉換路徑設計 (Conversion Path)**
+7. **關鍵說服模組庫 (Reusable Blocks)**
+8. **整體策略總結 (Strategic Summary)**
+
+請使用 Markdown 輸出，最後附上一個小節：
+**《可直接套用的設計原則清單》**，條列 5–10 點即可。
+""")
+
+PROMPT_S2_NOPAGE = string.Template("""
+# Role
+你是一位資深 CRO 顧問與 Landing Page 策略設計師。
+
+# 競品洞察背景
+以下為 Step 1 的競品拆解摘要：
+${step1_result}
+
+# Case: 客戶目前沒有 Landing Page。
+
+# 客戶基本資訊
+- 主訴求（value proposition）：${client_proposition}
+- 目標受眾（audience）：${client_audience}
+- 主要 CTA：${client_cta}
+
+# 客戶補充資訊與文件
+請參考我上傳的文件（如有，包含產品資料、簡報等）以及以下文字說明：
+${our_text}
+
+# 你的任務
+請作為資深 CRO 顧問，協助我為「沒有頁面」的客戶建立一份《Landing Page 初版定位與建議結構》。
+請參考我提供的補充文件來萃取產品優勢與痛點。
+
+請輸出：
+
+1. **核心定位摘要**
+2. **建議的頁面模組架構（從零開始）**
+3. **風險與常見錯誤**
+4. **可直接交給 Step 3 的「草稿訊息」：
+   - Hero headline＋subheadline
+   - 3 個痛點（Problem）
+   - 3 個利益點（Benefit）
+   - 推薦 CTA 文案
+   - 初步信任元素
+
+請用 Markdown 條列清晰輸出。
+""")
+
+PROMPT_S2_UNCLEAR = string.Template("""
+# Role
+你是一位資深 CRO 顧問與 Landing Page 策略設計師。
+
+# 競品洞察背景
+以下為 Step 1 的競品拆解摘要：
+${step1_result}
+
+# Case: 客戶有頁面，但主訴求與受眾定位不清楚。
+
+# 客戶基本資訊
+- 客戶主訴求（value proposition）：${client_proposition}
+- 客戶受眾（audience）：${client_audience}
+- 主要 CTA：${client_cta}
+
+# 客戶現有頁面資料與補充文件
+${our_text}
+(請同時參考附件檔案，可能是產品文件或現有頁面截圖)
+
+# 你的任務
+請你站在「CRO 顧問」的角度，協助我進行《定位校正 + 頁面差異診斷》。
+
+請輸出：
+
+1. **頁面與主訴求／受眾是否一致？**
+2. **缺失清單（Missing Elements）**
+3. **優先修正清單（Immediate Fixes）**
+4. **定位校正後的核心訊息草稿：
+   - Hero headline + subheadline
+   - 受眾描述
+   - 3 點利益點
+   - 新版 CTA 建議
+
+請以 Markdown 輸出。
+""")
+
+PROMPT_S2_NORMAL = string.Template("""
+# Role
+你是一位資深 CRO 顧問與 Landing Page 策略設計師。
+
+# 競品洞察背景
+以下為 Step 1 的競品拆解摘要：
+${step1_result}
+
+# Case: 客戶已有頁面，定位清楚，可直接進行差異分析。
+
+# 客戶資訊
+- 主訴求：${client_proposition}
+- 受眾：${client_audience}
+- CTA：${client_cta}
+
+# 客戶現有頁面內容與補充文件
+${our_text}
+(請同時參考附件檔案)
+
+# 你的任務
+請基於以上資訊，產出《我方 Landing Page 差異分析報告》。
+
+請包含：
+
+1. **現況摘要（3–5 句）**
+2. **頁面結構對照與差異（Structure vs Competitors）**
+3. **訊息缺口（Message Gap）**
+4. **轉換阻力（Friction Points）**
+5. **高優先項（3–5 個必改項目）**
+6. **可放大的優勢（Strengths to Amplify）**
+
+請以 Markdown 輸出。
+""")
+
+PROMPT_S3_FULL = string.Template("""
+# Role
+你是一位資深 CRO 顧問與 Landing Page 策略設計師。
+
+# 競品洞察背景
+以下為 Step 1 的競品拆解摘要：
+${step1_result}
+
+# 我方情境診斷
+以下為 Step 2 的診斷與建議：
+${step2_result}
+
+# 任務目標：全面重建 Landing Page
+請你以「資深 CRO 顧問 + Landing Page 產品設計師」的身份，
+根據上述競品洞察與診斷，重新打造一個 *完整重構版* Landing Page。
+
+本次目標：
+- 目標 CTA：${target_action}
+- 核心受眾：${target_audience}
+- 額外限制／品牌要求：
+${extra_constraints}
+
+# 請輸出《Landing Page 全面重建規格書》，內容需包含：
+
+1. **頁面定位摘要**
+2. **全新結構總覽 (New Page Architecture)**
+3. **逐區塊規格（Section-by-Section Specification）**
+4. **技術備註（For Designer & Front-end）**
+5. **A/B Test 起手式建議**
+
+# 格式要求
+${format_instruction}
+
+# 額外要求
+${additional_req}
+""")
+
+PROMPT_S3_PARTIAL = string.Template("""
+# Role
+你是一位資深 CRO 顧問與 Landing Page 策略設計師。
+
+# 競品洞察背景
+以下為 Step 1 的競品拆解摘要：
+${step1_result}
+
+# 我方情境診斷
+以下為 Step 2 的診斷與建議：
+${step2_result}
+
+# 任務目標：在有限資源下優化 LP
+假設目前「人力與時間有限」，無法全面重做 Landing Page。
+
+本次目標：
+- 主要 CTA：${target_action}
+- 核心受眾：${target_audience}
+- 限制條件：
+${extra_constraints}
+
+請你作為資深 CRO 顧問，輸出《Landing Page 有限資源優化指南》，內容包含：
+
+1. 優化優先順序（High / Medium / Low）,每個需優化項目請幫我舉例說明
+2. 優先區塊局部改寫（含局部修正版文案）
+3. 不可動區塊的建議調整方式
+4. 3–5 個「在 1 小時內就能改」的快速提升項目
+5. 可延後或下一版再改的 nice-to-have 項目
+
+請使用 Markdown 條列輸出。
+${format_instruction}
+
+# 額外要求
+${additional_req}
+""")
+
 # =========================
 # Word 處理函式
 # =========================
 
-def extract_text_from_docx(file_path: str) -> str:
-    """從 docx 檔案路徑提取文字"""
-    try:
-        doc = Document(file_path)
-        full_text = []
-        for para in doc.paragraphs:
-            text = para.text.strip()
-            if text:
-                full_text.append(text)
-        return '\n\n'.join(full_text)
-    except Exception as e:
-        st.error(f"Word 讀取失敗: {e}")
-        return ""
+_W_NS = '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}'
+_W_P, _W_R, _W_T, _W_TAB, _W_BR = (_W_NS + tag for tag in ('p', 'r', 't', 'tab', 'br'))
+_MC_FALLBACK = '{http://schemas.openxmlformats.org/markup-compatibility/2006}Fallback'
+
+def extract_text_from_docx(file_path: Union[str, BinaryIO]) -> str:
+    """
+    從 docx 檔案路徑或檔案物件提取文字（失敗時拋出例外，由呼叫端處理）
+    直接串流解析 word/document.xml，避免 python-docx 為每個段落建立包裝物件
+    """
+    with zipfile.ZipFile(file_path) as z:
+        xml = z.read('word/document.xml')
+
+    # 段落直接寫入 StringIO，不保留整份段落清單再 join
+    out = StringIO()
+    first = True
+    buf = []
+
+    def flush():
+        nonlocal first, buf
+        text = ''.join(buf).strip()
+        if text:
+            if not first:
+                out.write('\n\n')
+            out.write(text)
+            first = False
+        buf = []
+
+    # 位於 mc:Fallback 內的內容是 Choice 的重複版本（例如文字方塊），略過以免重複輸出
+    fallback_depth = 0
+    # 與 python-docx 的 oxml parser 一致：不展開實體，避免上傳檔案夾帶惡意 entity
+    events = etree.iterparse(
+        BytesIO(xml), events=('start', 'end'), tag=(_W_P, _W_T, _W_TAB, _W_BR, _MC_FALLBACK),
+        resolve_entities=False, huge_tree=False,
+    )
+    for event, el in events:
+        if el.tag == _MC_FALLBACK:
+            fallback_depth += 1 if event == 'start' else -1
+            continue
+        if fallback_depth:
+            continue
+        # 沒有外層 w:p 的段落才是獨立段落（含內文、表格、content control 內的段落）；
+        # 文字方塊等巢狀段落前後以換行併入外層段落
+        if event == 'start':
+            if el.tag == _W_P and next(el.iterancestors(_W_P), None) is not None:
+                buf.append('\n')
+            continue
+
+        if el.tag == _W_T:
+            buf.append(el.text or '')
+        elif el.tag == _W_TAB:
+            # w:pPr/w:tabs 內的 w:tab 是定位點設定，只有 run 內的才是實際的 tab 字元
+            if el.getparent().tag == _W_R:
+                buf.append('\t')
+        elif el.tag == _W_BR:
+            buf.append('\n')
+        elif next(el.iterancestors(_W_P), None) is None:
+            flush()
+            el.clear()
+        else:
+            buf.append('\n')
+    flush()
+    return out.getvalue()
+
+# Markdown 行首標記 -> 標題層級（None 代表項目符號）
+_MARKDOWN_LINE_MARKERS = {
+    '#': 1,
+    '##': 2,
+    '###': 3,
+    '-': None,
+    '*': None,
+}
+_BOLD_RE = re.compile(r'\*\*|__')
 
 def create_docx_from_markdown(markdown_text: str) -> BytesIO:
     """將 Markdown 文字轉換為 Word 檔案物件 (BytesIO)"""
@@ -51,18 +334,16 @@ def create_docx_from_markdown(markdown_text: str) -> BytesIO:
         line = line.strip()
         if not line:
             continue
-            
-        if line.startswith('# '):
-            doc.add_heading(line[2:], level=1)
-        elif line.startswith('## '):
-            doc.add_heading(line[3:], level=2)
-        elif line.startswith('### '):
-            doc.add_heading(line[4:], level=3)
-        elif line.startswith('- ') or line.startswith('* '):
-            doc.add_paragraph(line[2:], style='List Bullet')
+
+        marker, sep, content = line.partition(' ')
+        if sep and marker in _MARKDOWN_LINE_MARKERS:
+            level = _MARKDOWN_LINE_MARKERS[marker]
+            if level is None:
+                doc.add_paragraph(content, style='List Bullet')
+            else:
+                doc.add_heading(content, level=level)
         else:
-            clean_line = line.replace('**', '').replace('__', '')
-            doc.add_paragraph(clean_line)
+            doc.add_paragraph(_BOLD_RE.sub('', line))
             
     buffer = BytesIO()
     doc.save(buffer)
@@ -73,17 +354,13 @@ def create_docx_from_markdown(markdown_text: str) -> BytesIO:
 # Gemini 核心功能函式
 # =========================
 
-def configure_gemini(api_key: str) -> bool:
-    """設定 API Key"""
-    if not api_key:
-        st.error("❌ 請先在側邊欄輸入 Google Gemini API Key")
-        return False
-    try:
-        genai.configure(api_key=api_key)
-        return True
-    except Exception as e:
-        st.error(f"API Key 設定失敗: {e}")
-        return False
+@st.cache_resource(show_spinner=False)
+def get_genai_client(api_key: str):
+    """
+    取得綁定該 API Key 的 google-genai Client（跨 rerun 快取）
+    生成與批次都走此 Client，避免共用 genai.configure 全域設定而在 session 間串用 API Key
+    """
+    return google_genai.Client(api_key=api_key)
 
 def process_uploaded_file(uploaded_file):
     """
@@ -91,80 +368,263 @@ def process_uploaded_file(uploaded_file):
     - docx 會轉 txt 再上傳
     - 其他格式直接上傳
     - 支援圖片、PDF、影片、文字檔
-    回傳: Gemini File Object 或 None
+    會在背景執行緒中呼叫，因此不直接操作 Streamlit 元件
+    回傳: (Gemini File Object 或 None, 錯誤訊息或 None)
     """
     if uploaded_file is None:
-        return None
+        return None, None
     
+    tmp_path = None
     try:
         suffix = Path(uploaded_file.name).suffix.lower()
-        tmp_path = ""
         display_name = uploaded_file.name
 
-        # 建立暫存檔案
-        with tempfile.NamedTemporaryFile(delete=False, suffix=suffix) as tmp:
-            tmp.write(uploaded_file.getvalue())
-            tmp_path = tmp.name
-
-        # 特殊處理 docx：先抽文字轉 txt，因為 Gemini API 對純文字檔支援度極佳
+        # 特殊處理 docx：直接在記憶體中抽文字轉 txt，因為 Gemini API 對純文字檔支援度極佳
         if suffix == '.docx':
-            text_content = extract_text_from_docx(tmp_path)
-            os.remove(tmp_path)
+            text_content = extract_text_from_docx(BytesIO(uploaded_file.getvalue()))
             with tempfile.NamedTemporaryFile(delete=False, suffix='.txt', mode='w', encoding='utf-8') as txt_tmp:
                 txt_tmp.write(text_content)
                 tmp_path = txt_tmp.name
                 display_name = f"{uploaded_file.name}.txt"
+        else:
+            # 建立暫存檔案
+            with tempfile.NamedTemporaryFile(delete=False, suffix=suffix) as tmp:
+                tmp.write(uploaded_file.getvalue())
+                tmp_path = tmp.name
 
         # 上傳到 Gemini File API
-        with st.spinner(f"正在上傳並處理檔案: {uploaded_file.name} ..."):
-            gemini_file = genai.upload_file(path=tmp_path, display_name=display_name)
-            
-            # 等待處理完成（加上 timeout）
-            max_wait = 60  # 最多等 60 秒
-            elapsed = 0
-            while getattr(gemini_file, "state", None) and gemini_file.state.name == "PROCESSING" and elapsed < max_wait:
-                time.sleep(1)
-                elapsed += 1
-                gemini_file = genai.get_file(gemini_file.name)
-            
-            if not getattr(gemini_file, "state", None) or gemini_file.state.name == "FAILED" or elapsed >= max_wait:
-                st.error(f"檔案 {uploaded_file.name} 處理失敗或逾時。")
-                if os.path.exists(tmp_path):
-                    os.remove(tmp_path)
-                return None
-                
-        if os.path.exists(tmp_path):
-            os.remove(tmp_path)
+        gemini_file = genai.upload_file(path=tmp_path, display_name=display_name)
+        
+        # 等待處理完成（指數退避輪詢，加上 timeout）
+        max_wait = 60  # 最多等 60 秒
+        delay = 0.1
+        deadline = time.monotonic() + max_wait
+        while getattr(gemini_file, "state", None) and gemini_file.state.name == "PROCESSING" and time.monotonic() < deadline:
+            time.sleep(delay)
+            delay = min(delay * 2, 2.0)
+            gemini_file = genai.get_file(gemini_file.name)
+        
+        if not getattr(gemini_file, "state", None) or gemini_file.state.name in ("PROCESSING", "FAILED"):
+            return None, f"檔案 {uploaded_file.name} 處理失敗或逾時。"
             
-        return gemini_file
+        return gemini_file, None
 
     except Exception as e:
-        st.error(f"上傳錯誤 ({uploaded_file.name}): {e}")
-        return None
+        return None, f"上傳錯誤 ({uploaded_file.name}): {e}"
+    finally:
+        # 不論成功或失敗都清除暫存檔
+        if tmp_path:
+            with suppress(FileNotFoundError):
+                os.unlink(tmp_path)
+
+def _is_still_valid(gemini_file) -> bool:
+    """確認先前上傳的檔案仍存在於 Gemini File API（未因 TTL 被清除）"""
+    try:
+        current = genai.get_file(gemini_file.name)
+        return getattr(current, "state", None) is not None and current.state.name == "ACTIVE"
+    except Exception:
+        return False
 
-def generate_content_stream(model_name: str, prompt: str, files=None) -> str | None:
-    """呼叫 Gemini API 生成內容"""
+def _reuse_or_upload(uploaded_file, cached_file):
+    """有可用的快取就直接沿用，否則重新上傳（在背景執行緒中執行）"""
+    if cached_file is not None and _is_still_valid(cached_file):
+        return cached_file, None
+    return process_uploaded_file(uploaded_file)
+
+def hash_uploaded_files(uploaded_files) -> list:
+    """計算上傳檔案內容的 sha256（略過 None），順序與 process_uploaded_files 一致"""
+    return [hashlib.sha256(f.getvalue()).hexdigest() for f in (uploaded_files or []) if f is not None]
+
+def process_uploaded_files(uploaded_files, file_hashes=None) -> list:
+    """
+    平行處理多個上傳檔案（網路 I/O 為主，使用執行緒）
+    以檔案內容的 sha256 快取已上傳的 Gemini 檔案，跨 rerun 與各 Step 重複使用
+    file_hashes 可傳入 hash_uploaded_files 的結果，避免大檔重複計算雜湊
+    錯誤訊息於主執行緒統一顯示
+    回傳: 成功的 Gemini File Object 清單
+    """
+    uploaded_files = [f for f in (uploaded_files or []) if f is not None]
+    if not uploaded_files:
+        return []
+
+    file_cache = st.session_state.setdefault('_file_cache', {})
+    hashes = file_hashes if file_hashes is not None else hash_uploaded_files(uploaded_files)
+    cached_files = [file_cache.get(h) for h in hashes]
+
+    with st.spinner(f"正在上傳並處理 {len(uploaded_files)} 個檔案 ..."):
+        with ThreadPoolExecutor(max_workers=min(8, len(uploaded_files))) as ex:
+            results = list(ex.map(_reuse_or_upload, uploaded_files, cached_files))
+
+    gemini_files = []
+    for h, (gemini_file, error_msg) in zip(hashes, results):
+        if error_msg:
+            st.error(error_msg)
+            file_cache.pop(h, None)
+        if gemini_file:
+            file_cache[h] = gemini_file
+            gemini_files.append(gemini_file)
+    return gemini_files
+
+def _stream_content(api_key: str, model_name: str, prompt: str, files, service_tier: str = "standard"):
+    """
+    透過 google-genai 串流生成，非 standard 時指定 service tier
+    先取第一個 chunk，讓不支援 tier 等錯誤在此拋出，方便呼叫端退回 standard
+    """
+    contents = [prompt]
+    for f in files:
+        contents.append(google_genai.types.Part.from_uri(file_uri=f.uri, mime_type=f.mime_type))
+
+    config = {"temperature": 0.7}
+    if service_tier != "standard":
+        config["http_options"] = {"extra_body": {"serviceTier": service_tier}}
+
+    response = get_genai_client(api_key).models.generate_content_stream(
+        model=model_name,
+        contents=contents,
+        config=config,
+    )
+    first = next(response)
+    return (chunk.text for chunk in itertools.chain([first], response) if chunk.text)
+
+def generate_content_stream(api_key: str, model_name: str, prompt: str, files=None, service_tier: str = "standard") -> str | None:
+    """
+    呼叫 Gemini API 串流生成內容，邊生成邊顯示，完成後回傳完整文字
+    service_tier 為 "priority" 時走低延遲佇列，失敗則退回 standard
+    呼叫端需先確認已輸入 API Key
+    """
     try:
-        model = genai.GenerativeModel(model_name)
         if files is None:
             files = []
-        
-        content_parts = [prompt]
-        if files:
-            content_parts.extend(files)
             
         with st.spinner(f"正在使用 {model_name} 模型進行深度運算中..."):
-            response = model.generate_content(
-                content_parts,
-                generation_config=genai.types.GenerationConfig(
-                    temperature=0.7,
-                )
-            )
-        return response.text
+            chunks = None
+            if service_tier != "standard":
+                try:
+                    chunks = _stream_content(api_key, model_name, prompt, files, service_tier)
+                except Exception as e:
+                    st.warning(f"{service_tier} tier 無法使用，改用 standard：{e}")
+
+            if chunks is None:
+                chunks = _stream_content(api_key, model_name, prompt, files)
+
+        # 逐段顯示生成內容；完成後清除暫時區塊，交由各 Step 的結果區統一呈現
+        placeholder = st.empty()
+        full_text = placeholder.write_stream(chunks)
+        placeholder.empty()
+        return full_text or None
     except Exception as e:
         st.error(f"生成錯誤: {e}")
         return None
 
+# =========================
+# Gemini Batch API（離線批次，半價）
+# =========================
+
+BATCH_FAILED_STATES = ("JOB_STATE_FAILED", "JOB_STATE_CANCELLED", "JOB_STATE_EXPIRED")
+
+def submit_batch_job(api_key: str, model_name: str, prompt: str, files=None, display_name: str = "lp-toolkit") -> str | None:
+    """提交單一 prompt 的批次工作，回傳 job name"""
+    try:
+        parts = [{"text": prompt}]
+        for f in files or []:
+            parts.append({"file_data": {"file_uri": f.uri, "mime_type": f.mime_type}})
+
+        job = get_genai_client(api_key).batches.create(
+            model=model_name,
+            src=[{
+                "contents": [{"role": "user", "parts": parts}],
+                "config": {"temperature": 0.7},
+            }],
+            config={"display_name": display_name},
+        )
+        return job.name
+    except Exception as e:
+        st.error(f"批次提交錯誤: {e}")
+        return None
+
+def render_batch_status(step: int, api_key: str):
+    """顯示已提交的批次工作，並提供「檢查批次結果」按鈕，完成後寫回 stepN_result"""
+    job_name = st.session_state.get(f"step{step}_batch")
+    if not job_name:
+        return
+    cache_key = st.session_state.get(f"step{step}_batch_cache_key")
+
+    st.info(f"⏳ Step {step} 批次工作已提交：`{job_name}`（最長約 24 小時內完成）")
+    if not st.button("🔄 檢查批次結果", key=f"btn_s{step}_batch"):
+        return
+
+    try:
+        job = get_genai_client(api_key).batches.get(name=job_name)
+        state = job.state.name
+        if state == "JOB_STATE_SUCCEEDED":
+            response = job.dest.inlined_responses[0]
+            text = response.response.text if response.response else None
+            if response.error:
+                st.error(f"批次生成錯誤: {response.error}")
+            elif not text:
+                st.error("批次生成錯誤: 模型未回傳內容（可能遭安全機制阻擋）")
+            else:
+                st.session_state[f"step{step}_result"] = text
+                if cache_key:
+                    save_cached_result(cache_key, step, job.model, text)
+                st.success(f"Step {step} 批次結果已取回！")
+            st.session_state[f"step{step}_batch"] = ""
+        elif state in BATCH_FAILED_STATES:
+            st.error(f"批次工作失敗（{state}）")
+            st.session_state[f"step{step}_batch"] = ""
+        else:
+            st.info(f"批次工作尚未完成（{state}），請稍後再檢查。")
+    except Exception as e:
+        st.error(f"批次查詢錯誤: {e}")
+
+# =========================
+# 結果磁碟快取（跨 session / 重啟沿用相同輸入的結果）
+# =========================
+
+CACHE_DIR = Path(".lp_cache")
+
+def result_cache_key(api_key: str, model_name: str, prompt: str, file_hashes=None) -> str:
+    """
+    以 API Key、prompt、模型與上傳檔案內容雜湊（hash_uploaded_files）組成快取 key
+    納入 API Key 讓快取只在同一使用者之間共用，不會把別人的報告回傳給其他人
+    """
+    key_material = hashlib.sha256(api_key.encode('utf-8')).hexdigest() + prompt + model_name + ''.join(file_hashes or [])
+    return hashlib.sha256(key_material.encode('utf-8')).hexdigest()[:16]
+
+def _remember_cache_key(key: str):
+    """記錄本 session 用過的快取 key，供「重置所有分析」清除"""
+    keys = st.session_state.setdefault('_result_cache_keys', [])
+    if key not in keys:
+        keys.append(key)
+
+def load_cached_result(key: str) -> str | None:
+    """讀取先前存下的結果，沒有或損毀時回傳 None"""
+    try:
+        with open(CACHE_DIR / f"{key}.json", encoding='utf-8') as fp:
+            result = json.load(fp).get("result") or None
+    except (OSError, ValueError):
+        return None
+    if result:
+        _remember_cache_key(key)
+    return result
+
+def save_cached_result(key: str, step: int, model_name: str, result: str):
+    """將結果寫入磁碟快取（寫入失敗不影響主流程）"""
+    try:
+        CACHE_DIR.mkdir(exist_ok=True)
+        with open(CACHE_DIR / f"{key}.json", 'w', encoding='utf-8') as fp:
+            json.dump({"step": step, "model": model_name, "result": result}, fp, ensure_ascii=False)
+        _remember_cache_key(key)
+    except OSError:
+        pass
+
+def evict_cached_results():
+    """刪除本 session 讀寫過的磁碟快取"""
+    for key in st.session_state.get('_result_cache_keys', []):
+        with suppress(FileNotFoundError):
+            os.unlink(CACHE_DIR / f"{key}.json")
+    st.session_state['_result_cache_keys'] = []
+
 # =========================
 # Session State 初始化
 # =========================
@@ -175,6 +635,11 @@ if 'step2_result' not in st.session_state:
     st.session_state.step2_result = ""
 if 'step3_result' not in st.session_state:
     st.session_state.step3_result = ""
+for _step in (1, 2, 3):
+    if f'step{_step}_batch' not in st.session_state:
+        st.session_state[f'step{_step}_batch'] = ""
+    if f'step{_step}_batch_cache_key' not in st.session_state:
+        st.session_state[f'step{_step}_batch_cache_key'] = ""
 
 # =========================
 # 側邊欄設定
@@ -194,6 +659,23 @@ with st.sidebar:
     ]
     selected_model = st.selectbox("使用模型", model_options, index=0)
     
+    st.markdown("### 💸 執行方式")
+    batch_mode = st.checkbox(
+        "Overnight batch mode (50% off)",
+        help="改用 Gemini Batch API 非同步執行（最長約 24 小時），費用約為一般呼叫的一半；完成後按各 Step 的「檢查批次結果」取回。"
+    )
+    
+    priority_tier = st.toggle(
+        "Priority tier (faster, ~2x cost)",
+        value=True,
+        help="Step 3 使用 Priority service tier 以降低等待時間；超出配額時自動退回 standard。Step 1/2 一律使用 standard。"
+    )
+    
+    ignore_cache = st.checkbox(
+        "忽略已儲存結果（重新生成）",
+        help="勾選後即使輸入相同也會重新呼叫模型，並以新結果覆蓋已儲存的版本。"
+    )
+    
     st.markdown("---")
     st.info(f"當前優先使用: **{selected_model}**")
     
@@ -201,8 +683,19 @@ with st.sidebar:
         st.session_state.step1_result = ""
         st.session_state.step2_result = ""
         st.session_state.step3_result = ""
+        st.session_state.step1_batch = ""
+        st.session_state.step2_batch = ""
+        st.session_state.step3_batch = ""
+        st.session_state.step1_batch_cache_key = ""
+        st.session_state.step2_batch_cache_key = ""
+        st.session_state.step3_batch_cache_key = ""
+        evict_cached_results()
         st.rerun()
 
+# 每次執行只設定一次 API Key（供檔案上傳等模組層級呼叫使用）
+if api_key:
+    genai.configure(api_key=api_key)
+
 # =========================
 # 主標題
 # =========================
@@ -236,45 +729,35 @@ with tab1:
         competitor_text = st.text_area("貼上競品 LP 連結 / 文案 / 結構描述 (選填)", height=180)
 
     if st.button("🚀 執行 Step 1 競品分析", type="primary", key="btn_s1"):
-        if configure_gemini(api_key):
-            gemini_files_s1 = []
-            if competitor_files:
-                for f in competitor_files:
-                    g_file = process_uploaded_file(f)
-                    if g_file:
-                        gemini_files_s1.append(g_file)
-            
-            prompt_s1 = f"""
-# Role
-你是一位資深 CRO 顧問與 Landing Page 策略設計師。
-
-# 任務目標
-請針對我提供的【競品 Landing Page 資料】進行「結構化的逆向工程」，輸出一份《競品 Landing Page 戰略拆解報告》。
-
-競品資料來源包含：
-1. 我上傳的檔案與截圖（請一併納入分析）
-2. 我補充貼上的文字說明或網址：
-{competitor_text}
-
-# 分析觀點
-請聚焦在「如何說服訪客完成轉換」，從以下角度拆解：
+        if not api_key:
+            st.error("❌ 請先在側邊欄輸入 Google Gemini API Key")
+        else:
+            prompt_s1 = PROMPT_S1.substitute(
+                competitor_text=competitor_text,
+            )
+            file_hashes_s1 = hash_uploaded_files(competitor_files)
+            cache_key = result_cache_key(api_key, selected_model, prompt_s1, file_hashes_s1)
+            cached_result = None if ignore_cache else load_cached_result(cache_key)
+            if cached_result:
+                st.session_state.step1_result = cached_result
+                st.success("Step 1 競品分析完成！（沿用先前相同輸入的結果）")
+            else:
+                # 快取未命中才上傳檔案（快取 key 只需本地檔案雜湊）
+                gemini_files_s1 = process_uploaded_files(competitor_files, file_hashes_s1)
+                if batch_mode:
+                    job_name = submit_batch_job(api_key, selected_model, prompt_s1, gemini_files_s1, display_name="lp-step1")
+                    if job_name:
+                        st.session_state.step1_batch = job_name
+                        st.session_state.step1_batch_cache_key = cache_key
+                        st.success("Step 1 已提交批次工作，完成後請按「檢查批次結果」取回。")
+                else:
+                    result = generate_content_stream(api_key, selected_model, prompt_s1, gemini_files_s1)
+                    if result:
+                        st.session_state.step1_result = result
+                        save_cached_result(cache_key, 1, selected_model, result)
+                        st.success("Step 1 競品分析完成！")
 
-1. **定位與主張 (Positioning & Core Promise)**
-2. **頁面結構與資訊架構 (Information Architecture)**
-3. **首屏設計 (Above-the-fold Strategy)**
-4. **文案語氣與說服手法 (Copy & Persuasion Technique)**
-5. **視覺與互動策略 (Visual & Interaction)**
-6. **轉換路徑設計 (Conversion Path)**
-7. **關鍵說服模組庫 (Reusable Blocks)**
-8. **整體策略總結 (Strategic Summary)**
-
-請使用 Markdown 輸出，最後附上一個小節：
-**《可直接套用的設計原則清單》**，條列 5–10 點即可。
-"""
-            result = generate_content_stream(selected_model, prompt_s1, gemini_files_s1)
-            if result:
-                st.session_state.step1_result = result
-                st.success("Step 1 競品分析完成！")
+    render_batch_status(1, api_key)
 
     if st.session_state.step1_result:
         st.markdown("---")
@@ -337,121 +820,61 @@ with tab2:
             )
 
         if st.button("🚀 執行 Step 2 情境診斷", type="primary", key="btn_s2"):
-            if configure_gemini(api_key):
-                gemini_files_s2 = []
-                
-                # --- 修正邏輯：只要有上傳檔案就處理，不限制模式 ---
-                if our_files:
-                    for f in our_files:
-                        g_file = process_uploaded_file(f)
-                        if g_file:
-                            gemini_files_s2.append(g_file)
-                # ---------------------------------------------
-                
+            if not api_key:
+                st.error("❌ 請先在側邊欄輸入 Google Gemini API Key")
+            else:
                 # 根據模式選擇 prompt
+                # Role 與 Step 1 結果固定放在開頭，讓 Step 2/3 各模式共用相同前綴以命中 Gemini implicit caching
                 if step2_mode == "客戶沒有頁面（No Page）":
-                    prompt_s2 = f"""
-# Case: 客戶目前沒有 Landing Page。
-
-# 客戶基本資訊
-- 主訴求（value proposition）：{client_proposition}
-- 目標受眾（audience）：{client_audience}
-- 主要 CTA：{client_cta}
-
-# 客戶補充資訊與文件
-請參考我上傳的文件（如有，包含產品資料、簡報等）以及以下文字說明：
-{our_text}
-
-# 競品洞察背景
-以下為 Step 1 的競品拆解摘要：
-{st.session_state.step1_result}
-
-# 你的任務
-請作為資深 CRO 顧問，協助我為「沒有頁面」的客戶建立一份《Landing Page 初版定位與建議結構》。
-請參考我提供的補充文件來萃取產品優勢與痛點。
-
-請輸出：
-
-1. **核心定位摘要**
-2. **建議的頁面模組架構（從零開始）**
-3. **風險與常見錯誤**
-4. **可直接交給 Step 3 的「草稿訊息」：
-   - Hero headline＋subheadline
-   - 3 個痛點（Problem）
-   - 3 個利益點（Benefit）
-   - 推薦 CTA 文案
-   - 初步信任元素
-
-請用 Markdown 條列清晰輸出。
-"""
+                    prompt_s2 = PROMPT_S2_NOPAGE.substitute(
+                        step1_result=st.session_state.step1_result,
+                        client_proposition=client_proposition,
+                        client_audience=client_audience,
+                        client_cta=client_cta,
+                        our_text=our_text,
+                    )
                 elif step2_mode == "客戶有頁面但定位不清楚（Unclear）":
-                    prompt_s2 = f"""
-# Case: 客戶有頁面，但主訴求與受眾定位不清楚。
-
-# 客戶基本資訊
-- 客戶主訴求（value proposition）：{client_proposition}
-- 客戶受眾（audience）：{client_audience}
-- 主要 CTA：{client_cta}
-
-# 客戶現有頁面資料與補充文件
-{our_text}
-(請同時參考附件檔案，可能是產品文件或現有頁面截圖)
-
-# 競品背景
-Step 1 競品拆解摘要如下：
-{st.session_state.step1_result}
-
-# 你的任務
-請你站在「CRO 顧問」的角度，協助我進行《定位校正 + 頁面差異診斷》。
-
-請輸出：
-
-1. **頁面與主訴求／受眾是否一致？**
-2. **缺失清單（Missing Elements）**
-3. **優先修正清單（Immediate Fixes）**
-4. **定位校正後的核心訊息草稿：
-   - Hero headline + subheadline
-   - 受眾描述
-   - 3 點利益點
-   - 新版 CTA 建議
-
-請以 Markdown 輸出。
-"""
+                    prompt_s2 = PROMPT_S2_UNCLEAR.substitute(
+                        step1_result=st.session_state.step1_result,
+                        client_proposition=client_proposition,
+                        client_audience=client_audience,
+                        client_cta=client_cta,
+                        our_text=our_text,
+                    )
                 else:  # Normal
-                    prompt_s2 = f"""
-# Case: 客戶已有頁面，定位清楚，可直接進行差異分析。
-
-# 客戶資訊
-- 主訴求：{client_proposition}
-- 受眾：{client_audience}
-- CTA：{client_cta}
-
-# 客戶現有頁面內容與補充文件
-{our_text}
-(請同時參考附件檔案)
-
-# 競品拆解摘要
-{st.session_state.step1_result}
-
-# 你的任務
-請基於以上資訊，產出《我方 Landing Page 差異分析報告》。
-
-請包含：
-
-1. **現況摘要（3–5 句）**
-2. **頁面結構對照與差異（Structure vs Competitors）**
-3. **訊息缺口（Message Gap）**
-4. **轉換阻力（Friction Points）**
-5. **高優先項（3–5 個必改項目）**
-6. **可放大的優勢（Strengths to Amplify）**
-
-請以 Markdown 輸出。
-"""
-
-                result = generate_content_stream(selected_model, prompt_s2, gemini_files_s2)
-                if result:
-                    st.session_state.step2_result = result
-                    st.success("Step 2 情境診斷完成！")
+                    prompt_s2 = PROMPT_S2_NORMAL.substitute(
+                        step1_result=st.session_state.step1_result,
+                        client_proposition=client_proposition,
+                        client_audience=client_audience,
+                        client_cta=client_cta,
+                        our_text=our_text,
+                    )
+
+                file_hashes_s2 = hash_uploaded_files(our_files)
+                cache_key = result_cache_key(api_key, selected_model, prompt_s2, file_hashes_s2)
+                cached_result = None if ignore_cache else load_cached_result(cache_key)
+                if cached_result:
+                    st.session_state.step2_result = cached_result
+                    st.success("Step 2 情境診斷完成！（沿用先前相同輸入的結果）")
+                else:
+                    # --- 修正邏輯：只要有上傳檔案就處理，不限制模式 ---
+                    # 快取未命中才上傳檔案（快取 key 只需本地檔案雜湊）
+                    gemini_files_s2 = process_uploaded_files(our_files, file_hashes_s2)
+                    # ---------------------------------------------
+                    if batch_mode:
+                        job_name = submit_batch_job(api_key, selected_model, prompt_s2, gemini_files_s2, display_name="lp-step2")
+                        if job_name:
+                            st.session_state.step2_batch = job_name
+                            st.session_state.step2_batch_cache_key = cache_key
+                            st.success("Step 2 已提交批次工作，完成後請按「檢查批次結果」取回。")
+                    else:
+                        result = generate_content_stream(api_key, selected_model, prompt_s2, gemini_files_s2)
+                        if result:
+                            st.session_state.step2_result = result
+                            save_cached_result(cache_key, 2, selected_model, result)
+                            st.success("Step 2 情境診斷完成！")
+
+        render_batch_status(2, api_key)
 
         if st.session_state.step2_result:
             st.markdown("---")
@@ -510,86 +933,63 @@ with tab3:
         )
 
         if st.button("🚀 生成 Step 3 LP 產出", type="primary", key="btn_s3"):
-            if configure_gemini(api_key):
-                gemini_files_s3 = []
-                format_instruction = "請使用標準的 Markdown 條列與區塊標題格式輸出。"
+            if not api_key:
+                st.error("❌ 請先在側邊欄輸入 Google Gemini API Key")
+            else:
+                default_format_instruction = "請使用標準的 Markdown 條列與區塊標題格式輸出。"
+                example_format_instruction = "🚨 **格式嚴格要求**：請盡可能模仿附件檔案的「區塊結構」與「欄位架構」，但內容以我方產品為主。"
                 
-                if example_file:
-                    g_file = process_uploaded_file(example_file)
-                    if g_file:
-                        gemini_files_s3.append(g_file)
-                        format_instruction = "🚨 **格式嚴格要求**：請盡可能模仿附件檔案的「區塊結構」與「欄位架構」，但內容以我方產品為主。"
-                
-                if step3_mode == "全面重建（Full Rebuild）":
-                    prompt_s3 = f"""
-# Context
-Step 1 - 競品拆解重點：
-{st.session_state.step1_result}
-
-Step 2 - 我方情境診斷與建議：
-{st.session_state.step2_result}
-
-# 任務目標：全面重建 Landing Page
-請你以「資深 CRO 顧問 + Landing Page 產品設計師」的身份，
-根據上述 Context，重新打造一個 *完整重構版* Landing Page。
-
-本次目標：
-- 目標 CTA：{target_action}
-- 核心受眾：{target_audience}
-- 額外限制／品牌要求：
-{extra_constraints}
-
-# 請輸出《Landing Page 全面重建規格書》，內容需包含：
-
-1. **頁面定位摘要**
-2. **全新結構總覽 (New Page Architecture)**
-3. **逐區塊規格（Section-by-Section Specification）**
-4. **技術備註（For Designer & Front-end）**
-5. **A/B Test 起手式建議**
+                prompt_template_s3 = PROMPT_S3_FULL if step3_mode == "全面重建（Full Rebuild）" else PROMPT_S3_PARTIAL
+                prompt_fields_s3 = dict(
+                    step1_result=st.session_state.step1_result,
+                    step2_result=st.session_state.step2_result,
+                    target_action=target_action,
+                    target_audience=target_audience,
+                    extra_constraints=extra_constraints,
+                    additional_req=additional_req,
+                )
+                file_hashes_s3 = hash_uploaded_files([example_file])
 
-# 格式要求
-{format_instruction}
+                # 有範例檔時先以「上傳成功」的格式要求查快取，未命中才上傳
+                prompt_s3 = prompt_template_s3.substitute(
+                    prompt_fields_s3,
+                    format_instruction=example_format_instruction if example_file else default_format_instruction,
+                )
+                cache_key = result_cache_key(api_key, selected_model, prompt_s3, file_hashes_s3)
+                cached_result = None if ignore_cache else load_cached_result(cache_key)
 
-# 額外要求
-{additional_req}
-"""
+                gemini_files_s3 = []
+                if not cached_result and example_file:
+                    gemini_files_s3 = process_uploaded_files([example_file], file_hashes_s3)
+                    if not gemini_files_s3:
+                        # 範例檔上傳失敗：改用標準格式要求，重新組 prompt 與快取 key
+                        prompt_s3 = prompt_template_s3.substitute(
+                            prompt_fields_s3,
+                            format_instruction=default_format_instruction,
+                        )
+                        cache_key = result_cache_key(api_key, selected_model, prompt_s3, file_hashes_s3)
+                        cached_result = None if ignore_cache else load_cached_result(cache_key)
+
+                if cached_result:
+                    st.session_state.step3_result = cached_result
+                    st.success("Step 3 LP 產出完成！（沿用先前相同輸入的結果）")
+                elif batch_mode:
+                    job_name = submit_batch_job(api_key, selected_model, prompt_s3, gemini_files_s3, display_name="lp-step3")
+                    if job_name:
+                        st.session_state.step3_batch = job_name
+                        st.session_state.step3_batch_cache_key = cache_key
+                        st.success("Step 3 已提交批次工作，完成後請按「檢查批次結果」取回。")
                 else:
-                    prompt_s3 = f"""
-# Context
-Step 1 - 競品拆解重點：
-{st.session_state.step1_result}
-
-Step 2 - 我方情境診斷與 Gap：
-{st.session_state.step2_result}
-
-# 任務目標：在有限資源下優化 LP
-假設目前「人力與時間有限」，無法全面重做 Landing Page。
-
-本次目標：
-- 主要 CTA：{target_action}
-- 核心受眾：{target_audience}
-- 限制條件：
-{extra_constraints}
-
-請你作為資深 CRO 顧問，輸出《Landing Page 有限資源優化指南》，內容包含：
-
-1. 優化優先順序（High / Medium / Low）,每個需優化項目請幫我舉例說明
-2. 優先區塊局部改寫（含局部修正版文案）
-3. 不可動區塊的建議調整方式
-4. 3–5 個「在 1 小時內就能改」的快速提升項目
-5. 可延後或下一版再改的 nice-to-have 項目
-
-請使用 Markdown 條列輸出。
-{format_instruction}
-
-# 額外要求
-{additional_req}
-"""
-
-                result = generate_content_stream(selected_model, prompt_s3, gemini_files_s3)
-                if result:
-                    st.session_state.step3_result = result
-                    st.success("Step 3 LP 產出完成！")
+                    result = generate_content_stream(
+                        api_key, selected_model, prompt_s3, gemini_files_s3,
+                        service_tier="priority" if priority_tier else "standard"
+                    )
+                    if result:
+                        st.session_state.step3_result = result
+                        save_cached_result(cache_key, 3, selected_model, result)
+                        st.success("Step 3 LP 產出完成！")
+
+        render_batch_status(3, api_key)
 
         if st.session_state.step3_result:
             st.markdown("---")